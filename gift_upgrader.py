@@ -1,17 +1,27 @@
 import asyncio
 import json
 import logging
+import operator
 import os
+import queue
 import random
 import signal
+import sqlite3
 import sys
+import threading
+import time
 from datetime import datetime, timezone
-from logging.handlers import RotatingFileHandler
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
 from pathlib import Path
 
+try:
+    import orjson
+except ImportError:  # необязательная зависимость — без неё просто stdlib json
+    orjson = None
+
 from dotenv import load_dotenv
 from prometheus_client import Counter, Gauge, start_http_server
-from telethon import TelegramClient, functions, types, events
+from telethon import TelegramClient, functions, types, events, utils
 from telethon.errors import FloodWaitError, RPCError
 
 # ────────────────────────────────────────────────────────────────────────────────
@@ -33,6 +43,8 @@ JITTER_MAX_SEC = float(os.getenv("JITTER_MAX_SEC", "0"))     # например
 
 # Реактивный триггер по новым сообщениям в канале
 FAST_ON_NEW_MSG = os.getenv("FAST_ON_NEW_MSG", "1") == "1"
+# Окно склейки всплеска сообщений в один скан (секунды)
+FAST_DEBOUNCE_SEC = float(os.getenv("FAST_DEBOUNCE_SEC", "2"))
 
 # Сухой прогон (ничего не платим, только логика)
 DRY_RUN = os.getenv("DRY_RUN", "0") == "1"
@@ -54,9 +66,29 @@ PAGE_LIMIT = max(1, min(100, int(os.getenv("PAGE_LIMIT", "100"))))
 # Сохранять детали исходника при апгрейде (если TL-слой поддерживает)
 KEEP_ORIGINAL_DETAILS = os.getenv("KEEP_ORIGINAL_DETAILS", "1") == "1"
 
+# FLOOD_WAIT до стольких секунд Telethon отсыпает сам (его дефолт тоже 60),
+# более длинные прилетают к нам как FloodWaitError
+FLOOD_SLEEP_THRESHOLD = int(os.getenv("FLOOD_SLEEP_THRESHOLD", "60"))
+
+# Сколько пиров сканируем параллельно (чтобы не ловить FLOOD_WAIT)
+PEER_CONCURRENCY = 4
+# Сколько апгрейдов держим в полёте одновременно (на весь процесс)
+UPGRADE_CONCURRENCY = 4
+
 # Файлики состояния/аудита
 AUDIT_JSONL = LOG_DIR / "audit.jsonl"
-STATE_DB = LOG_DIR / "upgraded_state.json"
+STATE_DB = LOG_DIR / "state.db"
+# Старые файлы состояния (до SQLite) — импортируются один раз при старте
+LEGACY_STATE_JSON = LOG_DIR / "upgraded_state.json"
+LEGACY_STATE_JOURNAL = LOG_DIR / "upgraded_state.jsonl"
+
+# JSON-сериализация: orjson, если установлен
+if orjson is not None:
+    def dumps(o) -> str:
+        return orjson.dumps(o).decode()
+else:
+    def dumps(o) -> str:
+        return json.dumps(o, ensure_ascii=False, separators=(",", ":"))
 
 # ────────────────────────────────────────────────────────────────────────────────
 # Logging
@@ -67,10 +99,13 @@ logger.setLevel(getattr(logging, LOG_LEVEL, logging.INFO))
 fmt = logging.Formatter("%(asctime)s | %(levelname)s | %(message)s", datefmt="%Y-%m-%d %H:%M:%S%z")
 ch = logging.StreamHandler(sys.stdout)
 ch.setFormatter(fmt)
-logger.addHandler(ch)
 fh = RotatingFileHandler(LOG_DIR / "gift_upgrader.log", maxBytes=5_000_000, backupCount=3, encoding="utf-8")
 fh.setFormatter(fmt)
-logger.addHandler(fh)
+# Запись (и ротация) логов — в отдельном потоке, event loop только кладёт в очередь
+_log_q = queue.SimpleQueue()
+logger.addHandler(QueueHandler(_log_q))
+_log_listener = QueueListener(_log_q, ch, fh, respect_handler_level=True)
+_log_listener.start()
 
 # ────────────────────────────────────────────────────────────────────────────────
 # Prometheus metrics
@@ -86,39 +121,171 @@ MET_FLOODWAIT = Counter("tg_gift_floodwait_seconds_total", "FLOOD_WAIT seconds")
 G_BALANCE = Gauge("tg_stars_balance", "Stars balance (XTR)")
 G_LAST_RUN_TS = Gauge("tg_last_run_timestamp", "Last scan UNIX ts")
 
+# Заранее связанные .inc для горячих путей (по подарку)
+_scanned_inc = MET_GIFTS_SCANNED.inc
+_upgradable_inc = MET_GIFTS_UPGRADABLE.inc
+_attempts_inc = MET_UPGR_ATTEMPTS.inc
+_success_inc = MET_UPGR_SUCCESS.inc
+_errors_inc = MET_ERRORS.inc
+
 # ────────────────────────────────────────────────────────────────────────────────
-# Tiny KV state
+# Tiny KV state (SQLite, WAL)
 # ────────────────────────────────────────────────────────────────────────────────
 
-def load_state() -> dict:
-    if STATE_DB.exists():
+def _open_state_db() -> sqlite3.Connection:
+    conn = sqlite3.connect(STATE_DB, isolation_level=None, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    # В WAL коммит без fsync: база остаётся целой, при сбое питания теряется лишь хвост
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("CREATE TABLE IF NOT EXISTS upgraded(k TEXT PRIMARY KEY, ts INTEGER)")
+    return conn
+
+def _import_legacy_state(conn: sqlite3.Connection) -> None:
+    """
+    Переносит upgraded_state.json (+ журнал) в SQLite и убирает старые файлы.
+    Повторный импорт безопасен (INSERT OR IGNORE), поэтому битый снапшот просто оставляем.
+    """
+    d = {}
+    parsed = True
+    if LEGACY_STATE_JSON.exists():
+        try:
+            d.update(json.loads(LEGACY_STATE_JSON.read_text(encoding="utf-8")))
+        except Exception as e:
+            parsed = False
+            logger.warning(f"Legacy state {LEGACY_STATE_JSON} is unreadable ({e}); keeping it for manual recovery")
+    if LEGACY_STATE_JOURNAL.exists():
+        with LEGACY_STATE_JOURNAL.open("r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    d.update(json.loads(line))
+                except Exception:
+                    continue
+    if d:
+        # isolation_level=None — autocommit, поэтому транзакцию открываем явно: один коммит в WAL
+        conn.execute("BEGIN")
         try:
-            return json.loads(STATE_DB.read_text(encoding="utf-8"))
+            conn.executemany("INSERT OR IGNORE INTO upgraded VALUES(?,?)", d.items())
         except Exception:
-            return {}
-    return {}
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+    # Старые файлы удаляем только после удачного импорта
+    if parsed:
+        for legacy in (LEGACY_STATE_JSON, LEGACY_STATE_JOURNAL):
+            legacy.unlink(missing_ok=True)
+
+STATE_CONN = _open_state_db()
+_import_legacy_state(STATE_CONN)
+# Соединение одно на процесс, а to_thread гоняет нас по разным потокам пула
+_STATE_LOCK = threading.Lock()
+
+def state_key(peer_id: int, gift_key: str) -> str:
+    return f"{peer_id}:{gift_key}"
 
-def save_state(d: dict) -> None:
-    tmp = STATE_DB.with_suffix(".tmp")
-    tmp.write_text(json.dumps(d, ensure_ascii=False, indent=2), encoding="utf-8")
-    tmp.replace(STATE_DB)
+def _db_already_upgraded(k: str) -> bool:
+    with _STATE_LOCK:
+        return STATE_CONN.execute("SELECT 1 FROM upgraded WHERE k=?", (k,)).fetchone() is not None
 
-STATE = load_state()
+def _db_upgraded_among(keys: list[str]) -> set[str]:
+    found = set()
+    with _STATE_LOCK:
+        # Страница <= 100 подарков, но режем на куски, чтобы не упереться в лимит переменных SQLite
+        for i in range(0, len(keys), 500):
+            chunk = keys[i:i + 500]
+            marks = ",".join("?" * len(chunk))
+            found.update(k for (k,) in STATE_CONN.execute(f"SELECT k FROM upgraded WHERE k IN ({marks})", chunk))
+    return found
 
-def state_key(peer_id, gift_key: str) -> str:
-    return f"{peer_id}:{gift_key}"
+def _db_mark_upgraded(k: str, ts: int) -> None:
+    with _STATE_LOCK:
+        STATE_CONN.execute("INSERT OR REPLACE INTO upgraded VALUES(?,?)", (k, ts))
 
-def already_upgraded(peer_id, gift_key: str) -> bool:
-    return state_key(peer_id, gift_key) in STATE
+async def already_upgraded(peer_id: int, gift_key: str) -> bool:
+    return await asyncio.to_thread(_db_already_upgraded, state_key(peer_id, gift_key))
 
-def mark_upgraded(peer_id, gift_key: str) -> None:
-    STATE[state_key(peer_id, gift_key)] = int(datetime.now(timezone.utc).timestamp())
-    save_state(STATE)
+async def upgraded_among(peer_id: int, gift_keys: list[str]) -> set[str]:
+    """
+    Какие из gift_keys уже апгрейжены — одним запросом на всю пачку.
+    """
+    if not gift_keys:
+        return set()
+    prefix = state_key(peer_id, "")
+    done = await asyncio.to_thread(_db_upgraded_among, [prefix + k for k in gift_keys])
+    return {k[len(prefix):] for k in done}
+
+async def mark_upgraded(peer_id: int, gift_key: str) -> None:
+    ts = int(datetime.now(timezone.utc).timestamp())
+    await asyncio.to_thread(_db_mark_upgraded, state_key(peer_id, gift_key), ts)
+
+# Аудит копится в очереди и пишется пачками фоновой задачей
+AUDIT_Q: asyncio.Queue = asyncio.Queue()
+AUDIT_BATCH = 64
+AUDIT_FLUSH_SEC = 0.2
+
+# Метка времени аудита с точностью до секунды, форматируется раз в секунду
+_cached_ts_sec = -1
+_cached_ts_str = ""
+
+def _audit_ts() -> str:
+    global _cached_ts_sec, _cached_ts_str
+    sec = int(time.time())
+    if sec != _cached_ts_sec:
+        _cached_ts_str = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(sec))
+        _cached_ts_sec = sec
+    return _cached_ts_str
 
 def append_audit(event: dict) -> None:
-    event["ts"] = datetime.now(timezone.utc).isoformat()
+    event["ts"] = _audit_ts()
+    AUDIT_Q.put_nowait(event)
+
+def _flush_audit(batch: list) -> None:
+    # Без fsync: аудит — не критичные данные, хватает атомарности append
     with AUDIT_JSONL.open("a", encoding="utf-8") as f:
-        f.write(json.dumps(event, ensure_ascii=False) + "\n")
+        f.writelines(dumps(ev) + "\n" for ev in batch)
+
+async def audit_writer_task() -> None:
+    """
+    Один писатель аудита: сбрасываем пачку раз в AUDIT_FLUSH_SEC или по AUDIT_BATCH событий.
+    """
+    batch = []
+    flush = None
+    try:
+        # Выходим и по STOP: в 3.11 wait_for может проглотить cancel, если get() успел завершиться
+        while not STOP.is_set():
+            try:
+                batch.append(await asyncio.wait_for(AUDIT_Q.get(), timeout=AUDIT_FLUSH_SEC))
+                if len(batch) < AUDIT_BATCH:
+                    continue
+            except asyncio.TimeoutError:
+                pass
+            if batch:
+                # Сериализация и запись — в потоке, event loop не ждёт диск.
+                # shield: при отмене поток всё равно допишет пачку, и мы его дождёмся
+                pending, batch = batch, []
+                flush = asyncio.ensure_future(asyncio.to_thread(_flush_audit, pending))
+                try:
+                    await asyncio.shield(flush)
+                except Exception as e:
+                    # Писатель один — не даём ему умереть, иначе очередь будет только расти
+                    _errors_inc()
+                    logger.exception(f"Audit flush failed, {len(pending)} events dropped: {e}")
+    finally:
+        # Сначала дожидаемся пачки в полёте, чтобы строки не перемешались с хвостом
+        if flush is not None and not flush.done():
+            try:
+                await flush
+            except Exception as e:
+                _errors_inc()
+                logger.exception(f"Audit flush failed on shutdown: {e}")
+        # Досливаем хвост при остановке
+        while not AUDIT_Q.empty():
+            batch.append(AUDIT_Q.get_nowait())
+        if batch:
+            try:
+                _flush_audit(batch)
+            except Exception as e:
+                _errors_inc()
+                logger.exception(f"Audit flush failed, {len(batch)} events dropped: {e}")
 
 # ────────────────────────────────────────────────────────────────────────────────
 # Helpers
@@ -132,12 +299,51 @@ def _require_tl_class(name: str):
         )
     return obj
 
+# Тип -> attrgetter поля с суммой (кэшируются только удачные совпадения)
+_amount_accessors: dict[type, object] = {}
+
+def _get_amount(x):
+    """
+    Достаёт amount/value/units как int (или None). Кэшированное поле пробуем первым;
+    если у экземпляра оно пустое/кривое — полный перебор, как раньше.
+    """
+    t = type(x)
+    acc = _amount_accessors.get(t)
+    if acc is not None:
+        try:
+            return int(acc(x))
+        except Exception:
+            pass
+    # Кэшируем поле, только если более приоритетных полей у объекта нет вовсе,
+    # иначе другой экземпляр того же типа мог бы разобраться по-другому
+    first_present = True
+    for attr in ("amount", "value", "units"):
+        if not hasattr(x, attr):
+            continue
+        v = getattr(x, attr)
+        if v is not None:
+            try:
+                n = int(v)
+            except Exception:
+                n = None
+            if n is not None:
+                if first_present:
+                    _amount_accessors[t] = operator.attrgetter(attr)
+                return n
+        first_present = False
+    return None
+
 def as_int_stars(x) -> int:
     """
     Приводит StarsAmount/число/строку к int.
     """
     if x is None:
         return 0
+    # Быстрые пути под реально приходящие типы
+    if type(x) is int:
+        return x
+    if StarsAmount is not None and type(x) is StarsAmount:
+        return int(x.amount)
     if isinstance(x, (int, float)):
         return int(x)
     if isinstance(x, str):
@@ -145,22 +351,9 @@ def as_int_stars(x) -> int:
             return int(float(x))
         except Exception:
             return 0
-    for attr in ("amount", "value", "units"):
-        v = getattr(x, attr, None)
-        if v is not None:
-            try:
-                return int(v)
-            except Exception:
-                pass
-    to_dict = getattr(x, "to_dict", None)
-    if callable(to_dict):
-        d = to_dict()
-        for k in ("amount", "value", "units"):
-            if k in d:
-                try:
-                    return int(d[k])
-                except Exception:
-                    pass
+    v = _get_amount(x)
+    if v is not None:
+        return v
     try:
         return int(x)
     except Exception:
@@ -171,6 +364,14 @@ InputPeerSelf = _require_tl_class("InputPeerSelf")
 InputSavedStarGiftUser = _require_tl_class("InputSavedStarGiftUser")
 InputSavedStarGiftChat = _require_tl_class("InputSavedStarGiftChat")
 InputInvoiceStarGiftUpgrade = _require_tl_class("InputInvoiceStarGiftUpgrade")
+# RPC-классы биндим один раз, а не ищем атрибутами на каждый вызов
+GetStarsStatusRequest = functions.payments.GetStarsStatusRequest
+GetSavedStarGiftsRequest = functions.payments.GetSavedStarGiftsRequest
+UpgradeStarGiftRequest = functions.payments.UpgradeStarGiftRequest
+GetPaymentFormRequest = functions.payments.GetPaymentFormRequest
+SendStarsFormRequest = functions.payments.SendStarsFormRequest
+# Необязательный: в старых слоях суммы приходят просто int
+StarsAmount = getattr(types, "StarsAmount", None)
 
 # ────────────────────────────────────────────────────────────────────────────────
 # Upgrader
@@ -179,6 +380,13 @@ InputInvoiceStarGiftUpgrade = _require_tl_class("InputInvoiceStarGiftUpgrade")
 class Upgrader:
     def __init__(self, client: TelegramClient):
         self.client = client
+        self._peer_sem = asyncio.Semaphore(PEER_CONCURRENCY)
+        self._upgrade_sem = asyncio.Semaphore(UPGRADE_CONCURRENCY)
+        # Баланс общий для параллельных сканов пиров — списываем под локом
+        self._balance = 0
+        self._balance_lock = asyncio.Lock()
+        # Кэш резолва PEERS -> (InputPeer*, числовой peer id), живёт весь процесс
+        self._peers: dict[str, tuple[object, int]] = {}
 
     async def report(self, text: str) -> None:
         try:
@@ -192,11 +400,11 @@ class Upgrader:
         и разные представления суммы (int / StarsAmount).
         """
         try:
-            st = await self.client(functions.payments.GetStarsStatusRequest(
+            st = await self.client(GetStarsStatusRequest(
                 peer=InputPeerSelf()
             ))
         except TypeError:
-            st = await self.client(functions.payments.GetStarsStatusRequest())
+            st = await self.client(GetStarsStatusRequest())
         except RPCError as e:
             logger.warning(f"getStarsStatus RPC error: {e}; balance=0")
             G_BALANCE.set(0)
@@ -213,43 +421,85 @@ class Upgrader:
         G_BALANCE.set(bal)
         return bal
 
-    async def resolve_peer(self, p: str):
+    async def resolve_peer(self, p: str) -> tuple[object, int]:
+        """
+        Возвращает (input_peer, peer_id); peer_id — короткий стабильный ключ для state.
+        """
         if str(p).lower() == "me":
-            return InputPeerSelf()
+            # Для RPC оставляем InputPeerSelf, а id берём у себя
+            me = await self.client.get_me(input_peer=True)
+            return InputPeerSelf(), utils.get_peer_id(me)
         try:
             if isinstance(p, str) and (p.startswith("-") or p.isdigit()):
                 p = int(p)
         except Exception:
             pass
-        return await self.client.get_input_entity(p)
+        peer = await self.client.get_input_entity(p)
+        return peer, utils.get_peer_id(peer)
 
-    async def iter_saved_gifts(self, peer, limit: int = PAGE_LIMIT):
+    async def resolve_peers(self) -> None:
+        """
+        Резолвим все PEERS один раз на старте; неудачные добираются лениво в цикле.
+        """
+        for p in PEERS:
+            try:
+                self._peers[p] = await self.resolve_peer(p)
+            except Exception as e:
+                logger.warning(f"resolve peer '{p}' failed: {e}; will retry on scan")
+
+    def watch_peers(self) -> list:
+        """
+        Закэшированные InputPeer* для реактивного триггера (me слушать смысла нет).
+        """
+        return [peer for p, (peer, _) in self._peers.items() if str(p).lower() != "me"]
+
+    async def _cached_peer(self, p: str) -> tuple[object, int]:
+        cached = self._peers.get(p)
+        if cached is None:
+            cached = self._peers[p] = await self.resolve_peer(p)
+        return cached
+
+    def _fetch_saved_gifts(self, peer, offset: str, limit: int):
+        return self.client(GetSavedStarGiftsRequest(
+            peer=peer,
+            offset=offset,
+            limit=limit,
+            exclude_unique=True  # уже уникальные (апгрейженные) не нужны
+        ))
+
+    async def iter_saved_gift_pages(self, peer, limit: int = PAGE_LIMIT):
         """
         Пагинация: payments.getSavedStarGifts(peer, offset, limit, exclude_unique=True)
+        Отдаёт страницы (списки подарков). Следующая страница запрашивается заранее,
+        пока обрабатывается текущая.
         """
-        offset = ""
-        while True:
-            res = await self.client(functions.payments.GetSavedStarGiftsRequest(
-                peer=peer,
-                offset=offset,
-                limit=limit,
-                exclude_unique=True  # уже уникальные (апгрейженные) не нужны
-            ))
-            gifts = getattr(res, "gifts", []) or []
-            for g in gifts:
-                yield g
-            MET_GIFTS_SCANNED.inc(len(gifts))
-            offset = getattr(res, "next_offset", None)
-            if not offset:
-                break
+        res = await self._fetch_saved_gifts(peer, "", limit)
+        next_task = None
+        try:
+            while True:
+                gifts = getattr(res, "gifts", []) or []
+                offset = getattr(res, "next_offset", None)
+                # Неполная страница — последняя, лишний запрос за пустой не делаем
+                if offset and len(gifts) >= limit:
+                    next_task = asyncio.create_task(self._fetch_saved_gifts(peer, offset, limit))
+                _scanned_inc(len(gifts))
+                yield gifts
+                if next_task is None:
+                    break
+                res = await next_task
+                next_task = None
+        finally:
+            if next_task is not None:
+                next_task.cancel()
 
     @staticmethod
     def _gift_need_and_flags(saved) -> tuple[int, bool, bool]:
-        # upgrade_stars может лежать и в saved, и внутри saved.gift
-        need = as_int_stars(getattr(saved, "upgrade_stars", 0))
+        # upgrade_stars может лежать и в saved, и внутри saved.gift (приоритет у gift)
+        raw_need = getattr(saved, "upgrade_stars", 0)
         sg = getattr(saved, "gift", None)
         if sg is not None:
-            need = as_int_stars(getattr(sg, "upgrade_stars", need))
+            raw_need = getattr(sg, "upgrade_stars", raw_need)
+        need = as_int_stars(raw_need)
         prepaid = bool(getattr(saved, "prepaid_upgrade_hash", None))
         can_upgrade = bool(getattr(saved, "can_upgrade", False))
         return need, prepaid, can_upgrade
@@ -277,13 +527,13 @@ class Upgrader:
         В некоторых слоях нет параметра keep_original_details — пробуем обе сигнатуры.
         """
         try:
-            await self.client(functions.payments.UpgradeStarGiftRequest(
+            await self.client(UpgradeStarGiftRequest(
                 stargift=inp,
                 keep_original_details=keep_original
             ))
         except TypeError:
             # слой без параметра — второй заход
-            await self.client(functions.payments.UpgradeStarGiftRequest(
+            await self.client(UpgradeStarGiftRequest(
                 stargift=inp
             ))
 
@@ -296,76 +546,209 @@ class Upgrader:
             keep_original_details=keep_original
         )
         try:
-            payform = await self.client(functions.payments.GetPaymentFormRequest(invoice=invoice))
+            payform = await self.client(GetPaymentFormRequest(invoice=invoice))
         except TypeError:
             # редкий слой: если ругнётся на поле, пробуем без него (сохранность деталей не критична)
             invoice = InputInvoiceStarGiftUpgrade(stargift=inp)
-            payform = await self.client(functions.payments.GetPaymentFormRequest(invoice=invoice))
+            payform = await self.client(GetPaymentFormRequest(invoice=invoice))
 
-        await self.client(functions.payments.SendStarsFormRequest(
+        await self.client(SendStarsFormRequest(
             form_id=payform.form_id,
             invoice=invoice
         ))
 
-    async def try_upgrade_one(self, saved, peer, stars_balance: int):
+    async def _reserve_stars(self, need: int) -> bool:
+        async with self._balance_lock:
+            if self._balance < need:
+                return False
+            self._balance -= need
+            return True
+
+    async def _refund_stars(self, amount: int) -> None:
+        async with self._balance_lock:
+            self._balance += amount
+
+    async def try_upgrade_one(self, saved, peer, peer_id: int, flags: tuple[int, bool, bool] | None = None,
+                              keys: tuple[str, object, str] | None = None):
         """
         Возвращает (ok: bool, msg: str, spent: int)
+        peer_id — числовой id пира (ключ в state), резолвится один раз.
+        flags — уже посчитанный _gift_need_and_flags(saved), если есть.
+        keys — уже посчитанный _gift_keys(saved, peer); с ним считается, что дедуп сделан вызывающим.
         """
-        need, prepaid, can_up = self._gift_need_and_flags(saved)
-        key, inp, key_type = self._gift_keys(saved, peer)
-        append_audit({"ev": "consider", "key": key, "peer": str(peer), "need": need, "prepaid": prepaid, "can_up": can_up})
+        if keys is None:
+            key, inp, key_type = self._gift_keys(saved, peer)
+            # Дедупликация одной и той же штуки — до любой другой работы и без аудита
+            if await already_upgraded(peer_id, key):
+                return False, f"skip: already_done ({key})", 0
+        else:
+            key, inp, key_type = keys
 
-        # Дедупликация одной и той же штуки
-        if already_upgraded(str(peer), key):
-            return False, f"skip: already_done ({key})", 0
+        need, prepaid, can_up = flags or self._gift_need_and_flags(saved)
+        append_audit({"ev": "consider", "key": key, "peer": peer_id, "need": need, "prepaid": prepaid, "can_up": can_up})
 
         if not can_up and not prepaid and need <= 0:
             return False, f"skip: not_upgradable ({key})", 0
 
-        MET_GIFTS_UPGRADABLE.inc()
+        _upgradable_inc()
 
         # 1) Предоплаченный апгрейд
         if prepaid:
-            MET_UPGR_ATTEMPTS.inc()
+            _attempts_inc()
             if DRY_RUN:
                 logger.info(f"[{key}] DRY_RUN prepaid upgradeStarGift")
                 append_audit({"ev": "dry_upgrade_prepaid", "key": key})
-                mark_upgraded(str(peer), key)
+                await mark_upgraded(peer_id, key)
                 return True, "prepaid-upgrade (dry)", 0
             try:
                 await self._upgrade_prepaid(inp, KEEP_ORIGINAL_DETAILS)
-                MET_UPGR_SUCCESS.inc()
+                _success_inc()
                 append_audit({"ev": "upgrade_prepaid_ok", "key": key})
-                mark_upgraded(str(peer), key)
+                await mark_upgraded(peer_id, key)
                 return True, "prepaid-upgrade OK", 0
             except RPCError as e:
                 logger.warning(f"[{key}] prepaid failed: {e}; trying paid flow")
 
         # 2) Платный апгрейд
         if need > 0:
-            if stars_balance < need:
-                return False, f"no-balance: need {need}, have {stars_balance}", 0
+            if self._balance < need:
+                return False, f"no-balance: need {need}, have {self._balance}", 0
 
-            MET_UPGR_ATTEMPTS.inc()
+            _attempts_inc()
             if DRY_RUN:
                 logger.info(f"[{key}] DRY_RUN paid upgrade need={need}")
                 append_audit({"ev": "dry_upgrade_paid", "key": key, "need": need})
-                mark_upgraded(str(peer), key)
+                await mark_upgraded(peer_id, key)
                 return True, f"paid-upgrade (dry) need={need}", 0
 
+            # Резервируем звёзды до оплаты, чтобы соседний пир не потратил их же
+            if not await self._reserve_stars(need):
+                return False, f"no-balance: need {need}, have {self._balance}", 0
             try:
                 await self._upgrade_paid(inp, need, KEEP_ORIGINAL_DETAILS)
-                MET_UPGR_SUCCESS.inc()
+                _success_inc()
                 append_audit({"ev": "upgrade_paid_ok", "key": key, "need": need})
-                mark_upgraded(str(peer), key)
+                await mark_upgraded(peer_id, key)
                 return True, f"paid-upgrade OK need={need}", need
             except RPCError as e:
-                MET_ERRORS.inc()
+                await self._refund_stars(need)
+                _errors_inc()
                 append_audit({"ev": "upgrade_paid_err", "key": key, "err": str(e)})
                 return False, f"paid-upgrade ERROR: {e}", 0
 
         return False, f"skip: uncertain ({key})", 0
 
+    async def _scan_peer(self, p: str) -> tuple[int, int, int]:
+        """
+        Сканирует один пир. Возвращает (found, upgraded, spent)
+        """
+        found = upgraded = spent_total = no_balance = 0
+        try:
+            peer, peer_id = await self._cached_peer(p)
+        except Exception as e:
+            MET_ERRORS.inc()
+            logger.error(f"resolve peer '{p}' failed: {e}")
+            return found, upgraded, spent_total
+
+        async with self._peer_sem:
+            logger.info(f"Scanning peer: {p}")
+            # Апгрейды идут постранично: пока обрабатываем страницу, следующая уже грузится,
+            # а ошибка пагинации не отменяет уже сделанное по прошлым страницам
+            try:
+                async for page in self.iter_saved_gift_pages(peer, PAGE_LIMIT):
+                    found += len(page)
+                    page_upgraded, page_spent, page_no_balance = await self._upgrade_page(p, page, peer, peer_id)
+                    upgraded += page_upgraded
+                    spent_total += page_spent
+                    no_balance += page_no_balance
+            except FloodWaitError:
+                raise
+            except RPCError:
+                # Сущность могла протухнуть — перерезолвим на следующем цикле
+                self._peers.pop(p, None)
+                raise
+            finally:
+                if found:
+                    logger.info(
+                        f"[{p}] scanned={found} upgraded={upgraded} no_balance={no_balance} "
+                        f"skipped={found - upgraded - no_balance}"
+                    )
+
+        if not found:
+            logger.info(f"No gifts found for peer {p}")
+        return found, upgraded, spent_total
+
+    async def _upgrade_page(self, p: str, page: list, peer, peer_id: int) -> tuple[int, int, int]:
+        """
+        Апгрейдит одну страницу подарков. Возвращает (upgraded, spent, no_balance)
+        """
+        # Ключи всей страницы и один запрос в state: уже сделанные отсеиваем до разбора флагов
+        keyed = []
+        for saved in page:
+            try:
+                keyed.append((saved, self._gift_keys(saved, peer)))
+            except Exception as e:
+                _errors_inc()
+                logger.error(f"[{p}] {e}")
+        done = await upgraded_among(peer_id, [keys[0] for _, keys in keyed])
+
+        # Сначала бесплатные (prepaid), потом те, на что хватает баланса, остальное в конце:
+        # возвраты звёзд от упавших оплат ещё могут сделать их доступными
+        prepaid, affordable, unaffordable = [], [], []
+        for saved, keys in keyed:
+            if keys[0] in done:
+                continue
+            flags = self._gift_need_and_flags(saved)
+            need, is_prepaid, _ = flags
+            if is_prepaid:
+                prepaid.append((saved, flags, keys))
+            elif need <= self._balance:
+                affordable.append((saved, flags, keys))
+            else:
+                unaffordable.append((saved, flags, keys))
+        if done:
+            logger.debug(f"[{p}] skip: already_done x{len(done)}")
+
+        upgraded = spent_total = no_balance = 0
+        for batch in (prepaid, affordable, unaffordable):
+            results = await asyncio.gather(*(
+                self._upgrade_guarded(p, saved, peer, peer_id, flags, keys) for saved, flags, keys in batch
+            ))
+            for ok, spent, short in results:
+                if ok:
+                    upgraded += 1
+                    spent_total += spent
+                no_balance += short
+        return upgraded, spent_total, no_balance
+
+    async def _upgrade_guarded(self, p: str, saved, peer, peer_id: int, flags, keys) -> tuple[bool, int, bool]:
+        """
+        try_upgrade_one под семафором и с разбором ошибок. Возвращает (ok, spent, no_balance)
+        """
+        async with self._upgrade_sem:
+            try:
+                ok, msg, spent = await self.try_upgrade_one(saved, peer, peer_id, flags, keys)
+                # Пропуски (в основном дедуп) и нехватка звёзд — только в DEBUG,
+                # их количество попадает в итоговую строку по пиру
+                short = msg.startswith("no-balance:")
+                if short or msg.startswith("skip:"):
+                    logger.debug(f"[{p}] {msg}")
+                else:
+                    logger.info(f"[{p}] {msg}")
+                return ok, spent, short
+            except FloodWaitError as fw:
+                # Короткие FLOOD_WAIT (<= FLOOD_SLEEP_THRESHOLD) Telethon отсыпает сам
+                MET_FLOODWAIT.inc(fw.seconds)
+                logger.warning(f"FLOOD_WAIT {fw.seconds}s on peer {p}; sleeping…")
+                await asyncio.sleep(fw.seconds + 1)
+            except RPCError as e:
+                _errors_inc()
+                logger.error(f"[{p}] RPC error: {e}")
+            except Exception as e:
+                _errors_inc()
+                logger.exception(f"[{p}] Unexpected: {e}")
+        return False, 0, False
+
     async def scan_and_upgrade_cycle(self) -> None:
         G_LAST_RUN_TS.set_to_current_time()
         MET_CHECKS.inc()
@@ -378,45 +761,29 @@ class Upgrader:
             MET_ERRORS.inc()
             logger.error(f"getStarsStatus failed: {e}")
             balance = 0
+        self._balance = balance
 
         total_found = 0
         total_upgraded = 0
         total_spent = 0
 
-        for p in PEERS:
-            try:
-                peer = await self.resolve_peer(p)
-            except Exception as e:
-                MET_ERRORS.inc()
-                logger.error(f"resolve peer '{p}' failed: {e}")
-                continue
+        # Пиры сканируем параллельно: Telethon мультиплексирует RPC по одному соединению
+        results = await asyncio.gather(*(self._scan_peer(p) for p in PEERS), return_exceptions=True)
 
-            logger.info(f"Scanning peer: {p}")
-            any_found = False
-            async for saved in self.iter_saved_gifts(peer, PAGE_LIMIT):
-                any_found = True
-                total_found += 1
-                try:
-                    ok, msg, spent = await self.try_upgrade_one(saved, peer, balance)
-                    if ok:
-                        total_upgraded += 1
-                        total_spent += spent
-                        if spent > 0:
-                            balance = max(0, balance - spent)
-                    logger.info(f"[{p}] {msg}")
-                except FloodWaitError as fw:
-                    MET_FLOODWAIT.inc(fw.seconds)
-                    logger.warning(f"FLOOD_WAIT {fw.seconds}s on peer {p}; sleeping…")
-                    await asyncio.sleep(fw.seconds + 1)
-                except RPCError as e:
-                    MET_ERRORS.inc()
-                    logger.error(f"[{p}] RPC error: {e}")
-                except Exception as e:
-                    MET_ERRORS.inc()
-                    logger.exception(f"[{p}] Unexpected: {e}")
+        # Длинный FLOOD_WAIT пробрасываем наверх (самый долгий) — там отсыпаемся
+        flood_waits = [res for res in results if isinstance(res, FloodWaitError)]
+        if flood_waits:
+            raise max(flood_waits, key=lambda fw: fw.seconds)
 
-            if not any_found:
-                logger.info(f"No gifts found for peer {p}")
+        for p, res in zip(PEERS, results):
+            if isinstance(res, BaseException):
+                MET_ERRORS.inc()
+                logger.error(f"[{p}] scan failed: {res!r}")
+                continue
+            found, upgraded, spent = res
+            total_found += found
+            total_upgraded += upgraded
+            total_spent += spent
 
         # Короткий отчёт
         msg = (
@@ -435,6 +802,7 @@ class Upgrader:
 
 STOP = asyncio.Event()
 SCAN_LOCK = asyncio.Lock()
+TRIGGER = asyncio.Event()
 
 def _setup_signals():
     def handler(sig, frame):
@@ -447,14 +815,53 @@ def _setup_signals():
         # Windows может ругаться на SIGTERM — ок
         pass
 
-async def _delay_with_jitter():
-    base = max(0.0, CHECK_EVERY_SEC)
-    jitter = random.uniform(0, JITTER_MAX_SEC) if JITTER_MAX_SEC > 0 else 0.0
-    delay = base + jitter
+def _next_deadline(prev_deadline: float, now: float) -> float:
+    """
+    Следующий тик считается от предыдущего дедлайна, а не от «сейчас» — без накопления дрейфа.
+    Пропущенные (пока шёл долгий скан) тики не догоняем: сдвигаемся на целое число
+    периодов, пока дедлайн не окажется в будущем, — фаза сохраняется.
+    """
+    period = max(0.0, CHECK_EVERY_SEC)
+    deadline = prev_deadline + period
+    if deadline <= now:
+        if period == 0:
+            return now
+        deadline += (int((now - deadline) // period) + 1) * period
+    return deadline
+
+async def _sleep_until(deadline: float) -> None:
+    """
+    Ждём до deadline (по loop.time()) или до STOP — что наступит раньше.
+    """
+    loop = asyncio.get_running_loop()
+    waiter = loop.create_future()
+    h = loop.call_at(deadline, waiter.set_result, None)
+    stop = asyncio.create_task(STOP.wait())
     try:
-        await asyncio.wait_for(STOP.wait(), timeout=delay)
-    except asyncio.TimeoutError:
-        pass
+        await asyncio.wait([waiter, stop], return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        h.cancel()
+        stop.cancel()
+
+async def _trigger_worker(upgr: Upgrader) -> None:
+    """
+    Один скан на пачку новых сообщений: ждём TRIGGER, выдерживаем окно FAST_DEBOUNCE_SEC,
+    всё, что пришло за это время, склеивается в тот же скан.
+    """
+    while not STOP.is_set():
+        await TRIGGER.wait()
+        await asyncio.sleep(FAST_DEBOUNCE_SEC)
+        TRIGGER.clear()
+        logger.info("Fast trigger: new message detected -> immediate scan")
+        try:
+            async with SCAN_LOCK:
+                await upgr.scan_and_upgrade_cycle()
+        except FloodWaitError as fw:
+            MET_FLOODWAIT.inc(fw.seconds)
+            logger.warning(f"Fast trigger FLOOD_WAIT {fw.seconds}s; sleeping…")
+            await asyncio.sleep(fw.seconds + 1)
+        except Exception as e:
+            logger.warning(f"Fast trigger scan error: {e}")
 
 async def main():
     if API_ID <= 0 or not API_HASH:
@@ -468,37 +875,45 @@ async def main():
         except Exception as e:
             logger.warning(f"Prometheus start failed: {e}")
 
-    client = TelegramClient(SESSION_NAME, API_ID, API_HASH)
+    # Апдейты нужны только реактивному триггеру
+    client = TelegramClient(
+        SESSION_NAME, API_ID, API_HASH,
+        flood_sleep_threshold=FLOOD_SLEEP_THRESHOLD,
+        receive_updates=FAST_ON_NEW_MSG,
+    )
     upgr = Upgrader(client)
 
     _setup_signals()
+    audit_task = asyncio.create_task(audit_writer_task())
+    try:
+        await _run(client, upgr)
+    finally:
+        STOP.set()
+        audit_task.cancel()
+        try:
+            await audit_task
+        except asyncio.CancelledError:
+            pass
+
+async def _run(client: TelegramClient, upgr: Upgrader) -> None:
     async with client:
         logger.info("Gift Upgrader started")
+        await upgr.resolve_peers()
 
-        # Подготовим список каналов для реактивного триггера (me слушать смысла нет)
-        watch_list = []
-        for p in PEERS:
-            if str(p).lower() == "me":
-                continue
-            try:
-                ent = await client.get_entity(p)
-                watch_list.append(ent)
-            except Exception as e:
-                logger.warning(f"Fast trigger: cannot resolve '{p}': {e}")
+        # Каналы для реактивного триггера — из уже отрезолвленного кэша
+        watch_list = upgr.watch_peers()
 
+        trigger_task = None
         if FAST_ON_NEW_MSG and watch_list:
             @client.on(events.NewMessage(chats=watch_list))
             async def _fast_trigger(event):
-                if SCAN_LOCK.locked():
-                    return
-                logger.info("Fast trigger: new message detected -> immediate scan")
-                try:
-                    async with SCAN_LOCK:
-                        await upgr.scan_and_upgrade_cycle()
-                except Exception as e:
-                    logger.warning(f"Fast trigger scan error: {e}")
+                TRIGGER.set()
+
+            trigger_task = asyncio.create_task(_trigger_worker(upgr))
 
-        # Основной цикл
+        # Основной цикл: джиттер добавляется к тику, но в базовый дедлайн не копится
+        loop = asyncio.get_running_loop()
+        deadline = loop.time()
         while not STOP.is_set():
             try:
                 async with SCAN_LOCK:
@@ -511,10 +926,18 @@ async def main():
                 MET_ERRORS.inc()
                 logger.exception(f"CYCLE error: {e}")
 
-            await _delay_with_jitter()
+            deadline = _next_deadline(deadline, loop.time())
+            jitter = random.uniform(0, JITTER_MAX_SEC) if JITTER_MAX_SEC > 0 else 0.0
+            await _sleep_until(deadline + jitter)
+
+        if trigger_task is not None:
+            trigger_task.cancel()
 
 if __name__ == "__main__":
     try:
         asyncio.run(main())
     except KeyboardInterrupt:
         pass
+    finally:
+        # Дописываем хвост очереди логов
+        _log_listener.stop()